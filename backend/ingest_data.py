@@ -1,11 +1,19 @@
+import hashlib
+import itertools
 import os
+import queue
+import random
+import threading
 from pathlib import Path
+import numpy as np
+import torch
 from sentence_transformers import SentenceTransformer
 from datasets import load_dataset
-from pymilvus import MilvusClient, DataType
+from pymilvus import Collection, DataType, MilvusClient, connections
 from tqdm import tqdm
 import pandas as pd
 from dotenv import load_dotenv
+from query_engline import get_client
 
 # Load environment variables
 load_dotenv()
@@ -14,200 +22,480 @@ load_dotenv()
 MODEL_NAME = os.getenv("EMBEDDING_MODEL", "nomic-ai/modernbert-embed-base")
 MILVUS_URI = os.getenv("MILVUS_URI", "http://localhost:19530")
 COLLECTION_NAME = os.getenv("COLLECTION_NAME", "modernbert_search")
+# Match the number of DataNodes; standalone Milvus has exactly one
+MILVUS_NUM_SHARDS = int(os.getenv("MILVUS_NUM_SHARDS", "1"))
+# Source dataset, and size and seed of the demo sample taken from it
+DATASET_NAME = "CShorten/ML-ArXiv-Papers"
+SAMPLE_SIZE = 1000
+SAMPLE_SEED = 57
+# "torch" (default) or "onnx"; the ONNX backend needs `optimum[onnxruntime]`
+# (or `optimum[onnxruntime-gpu]` for CUDA) installed
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch")
+EMBEDDING_BACKENDS = {"torch", "onnx"}
+# Intra-op threads one encoding process can use well; beyond this, CPU hosts
+# split the cores across several pool workers instead
+MAX_INTRA_OP_THREADS = 16
+
+
+def get_onnx_export(cache_dir: Path, device: str):
+    """Return (export dir, graph file, optimization level) for the ONNX backend.
+
+    The optimized graph is preferred; the plain export is used when the optimizer
+    does not support the model. The file is None until the model is exported.
+    """
+    # O4 adds FP16 on top of the O3 graph fusions but is only valid on GPU
+    optimization_level = "O4" if device == "cuda" else "O3"
+    onnx_dir = cache_dir / "onnx" / MODEL_NAME.replace("/", "__")
+    for onnx_file in (f"onnx/model_{optimization_level}.onnx", "onnx/model.onnx"):
+        if (onnx_dir / onnx_file).exists():
+            return onnx_dir, onnx_file, optimization_level
+    return onnx_dir, None, optimization_level
+
+
+def load_onnx_model(cache_dir: Path, device: str):
+    """Load the model through ONNX Runtime, exporting it on first use; returns (model, graph file)."""
+    from sentence_transformers import export_optimized_onnx_model
+
+    provider = "CUDAExecutionProvider" if device == "cuda" else "CPUExecutionProvider"
+    onnx_dir, onnx_file, optimization_level = get_onnx_export(cache_dir, device)
+
+    if onnx_file is None:
+        print(f"Exporting {MODEL_NAME} to ONNX ({optimization_level}) under {onnx_dir}...")
+        exported = SentenceTransformer(
+            MODEL_NAME,
+            cache_folder=str(cache_dir),
+            device=device,
+            backend="onnx",
+            model_kwargs={"provider": provider},
+        )
+        exported.save_pretrained(str(onnx_dir))
+        try:
+            export_optimized_onnx_model(exported, optimization_level, str(onnx_dir))
+        except (NotImplementedError, ValueError, KeyError) as e:
+            # Optimum only optimizes the model types it has fusion configs for
+            print(f"Warning: ONNX {optimization_level} optimization unavailable for {MODEL_NAME} ({e}); using the unoptimized export.")
+        onnx_dir, onnx_file, optimization_level = get_onnx_export(cache_dir, device)
+
+    print(f"Using ONNX graph {onnx_file}")
+    model = SentenceTransformer(
+        str(onnx_dir),
+        device=device,
+        backend="onnx",
+        model_kwargs={"file_name": onnx_file, "provider": provider},
+    )
+    return model, onnx_file
+
+
+def reservoir_sample(iterable, k, seed):
+    """Return a uniform random sample of k items from an iterable in one pass."""
+    rng = random.Random(seed)
+    items = iter(iterable)
+    sample = list(itertools.islice(items, k))
+    for seen, item in enumerate(items, start=k + 1):
+        slot = rng.randrange(seen)
+        if slot < k:
+            sample[slot] = item
+    return sample
+
+
+def get_rows_cache_path(cache_dir: Path):
+    """Return the cache file for the sampled rows, which depend only on the sample parameters."""
+    cache_key = hashlib.md5(f"{DATASET_NAME}|{SAMPLE_SEED}|{SAMPLE_SIZE}".encode()).hexdigest()
+    return cache_dir / f"rows_{cache_key}.parquet"
+
+
+def get_embeddings_cache_path(cache_dir: Path, device: str, model_file: str):
+    """Return the cache file for the sample's embeddings under the current model and device."""
+    # The model runs in FP16 on CUDA (torch .half() or the ONNX O4 graph) and FP32
+    # on CPU, so embeddings from the two differ and must not share a cache entry.
+    # model_file tells an optimized ONNX graph apart from the unoptimized fallback
+    encode_dtype = "float16" if device == "cuda" else "float32"
+    cache_key = hashlib.md5(
+        f"{DATASET_NAME}|{SAMPLE_SEED}|{SAMPLE_SIZE}|{MODEL_NAME}|{EMBEDDING_BACKEND}|{model_file}|{device}|{encode_dtype}".encode()
+    ).hexdigest()
+    return cache_dir / f"emb_{cache_key}.npy"
+
+
+def load_rows_cache(rows_cache: Path):
+    """Return (titles, abstracts) from the rows cache, or None if it is missing or unreadable."""
+    if not rows_cache.exists():
+        return None
+    try:
+        cached_rows = pd.read_parquet(rows_cache)
+    except Exception as e:
+        print(f"Ignoring unreadable rows cache ({e}), re-sampling.")
+        return None
+    return cached_rows["title"].tolist(), cached_rows["abstract"].tolist()
+
+
+def load_embeddings_cache(embeddings_cache: Path, row_count: int):
+    """Return the cached embeddings, or None if they are missing, unreadable or do not match the rows."""
+    if not embeddings_cache.exists():
+        return None
+    try:
+        cached_embeddings = np.load(embeddings_cache)
+    except Exception as e:
+        print(f"Ignoring unreadable embeddings cache ({e}), re-encoding.")
+        return None
+    if cached_embeddings.shape[0] != row_count:
+        print("Cached embeddings do not match the sampled rows, re-encoding.")
+        return None
+    return cached_embeddings
+
+
+def save_rows_cache(rows_cache: Path, titles, abstracts):
+    """Write the rows cache through a temporary file so a crash never leaves a truncated entry."""
+    rows_tmp = rows_cache.with_name(rows_cache.name + ".tmp")
+    pd.DataFrame({"title": titles, "abstract": abstracts}).to_parquet(rows_tmp)
+    os.replace(rows_tmp, rows_cache)
+
+
+def save_embeddings_cache(embeddings_cache: Path, embeddings):
+    """Write the embeddings cache through a temporary file so a crash never leaves a truncated entry."""
+    embeddings_tmp = embeddings_cache.with_name(embeddings_cache.name + ".tmp")
+    with open(embeddings_tmp, "wb") as f:
+        np.save(f, embeddings)
+    os.replace(embeddings_tmp, embeddings_cache)
+
+
+def get_target_devices():
+    """Return the devices to encode on: every GPU, or CPU workers.
+
+    Up to MAX_INTRA_OP_THREADS cores, the CPU is a single in-process device.
+    Larger hosts get one pool worker per MAX_INTRA_OP_THREADS cores; each worker
+    is limited to its share of the cores (see iter_embedding_chunks).
+    """
+    if torch.cuda.is_available():
+        return [f"cuda:{i}" for i in range(torch.cuda.device_count())]
+    return ["cpu"] * max(1, (os.cpu_count() or 1) // MAX_INTRA_OP_THREADS)
+
+
+def iter_embedding_chunks(model, texts, chunk_size):
+    """Yield (start, end, embeddings) for successive chunks of texts.
+
+    Embeddings are normalized and cast to float16 to match the FLOAT16_VECTOR
+    field. Work fans out across devices when more than one is available.
+    """
+    # The process pool moves a torch module onto each device, so ONNX stays in-process
+    target_devices = ["onnx"] if EMBEDDING_BACKEND == "onnx" else get_target_devices()
+    pool = None
+    if len(target_devices) > 1:
+        print(f"Encoding with a multi-process pool on: {', '.join(target_devices)}")
+        # Spawned workers re-import this module without running configure_torch(),
+        # so give each one a share of the cores through the environment it
+        # inherits instead of letting every worker default to all of them
+        previous_omp_threads = os.environ.get("OMP_NUM_THREADS")
+        os.environ["OMP_NUM_THREADS"] = str(max(1, (os.cpu_count() or 1) // len(target_devices)))
+        try:
+            pool = model.start_multi_process_pool(target_devices=target_devices)
+        finally:
+            if previous_omp_threads is None:
+                del os.environ["OMP_NUM_THREADS"]
+            else:
+                os.environ["OMP_NUM_THREADS"] = previous_omp_threads
 
-print("Step 1: Load the ModernBERT Model")
-# Load the SentenceTransformer model
-# Using a local cache directory within the project to avoid potential permission issues
-cache_dir = Path("./model_cache")
-cache_dir.mkdir(exist_ok=True)
-print(f"Loading embedding model: {MODEL_NAME}")
-model = SentenceTransformer(MODEL_NAME, cache_folder=str(cache_dir))
-print("Embedding model loaded.")
-
-# Function to generate embeddings for a single text
-def generate_embeddings_func(text: str):
-    return model.encode(text)
-
-print("Step 2: Prepare the Dataset")
-# Load the dataset
-ds = load_dataset("CShorten/ML-ArXiv-Papers")
-
-# Keep only "title" and "abstract" columns in train set
-train_ds = ds["train"].select_columns(["title", "abstract"])
-
-# Shuffle the dataset and select the first 1000 rows for demo
-print("Selecting and shuffling 1000 rows...")
-small_dataset = train_ds.shuffle(seed=57).select(range(1000))
-
-document_prefix = "search_document:"
-
-# Concatenate abstract and titles
-def combine_text(row):
-    row["text"] = document_prefix + " " + row["title"] + " " + row["abstract"]
-    return row
-
-print("Combining title and abstract...")
-small_dataset = small_dataset.map(combine_text)
-
-print(f"Number of rows to process: {len(small_dataset)}")
-
-print("Step 3: Generate Embeddings for the Dataset")
-# Function to generate embeddings for a batch
-def generate_embeddings_batch(batch):
-    # Ensure 'text' column exists
-    if "text" not in batch:
-        raise ValueError("Input batch must contain a 'text' column.")
-    
-    # Filter out None or empty strings if any, though combine_text should prevent this
-    texts_to_encode = [text for text in batch["text"] if text]
-    if not texts_to_encode:
-        batch["embeddings"] = []
-        return batch
-
-    embeddings = model.encode(texts_to_encode)
-    
-    # Map embeddings back, handling potential empty texts
-    embedding_iter = iter(embeddings)
-    batch_embeddings = []
-    for text in batch["text"]:
-        if text:
-            batch_embeddings.append(next(embedding_iter))
+    try:
+        for start in range(0, len(texts), chunk_size):
+            chunk = texts[start:start + chunk_size]
+            if pool is None:
+                with torch.inference_mode():
+                    embeddings = model.encode(
+                        chunk,
+                        batch_size=128, # Adjust batch_size based on memory
+                        convert_to_numpy=True,
+                        normalize_embeddings=True,
+                    )
+            else:
+                embeddings = model.encode_multi_process(
+                    chunk,
+                    pool,
+                    batch_size=64,
+                    normalize_embeddings=True,
+                )
+            yield start, start + len(chunk), embeddings.astype(np.float16)
+    finally:
+        if pool is not None:
+            model.stop_multi_process_pool(pool)
+
+
+def configure_torch():
+    """Tune PyTorch threading and matmul precision for in-process encoding."""
+    torch.set_num_threads(min(os.cpu_count() or 1, MAX_INTRA_OP_THREADS))
+    torch.set_num_interop_threads(2)
+    if torch.cuda.is_available():
+        # Lets any FP32 matmuls run on tensor cores
+        torch.backends.cuda.matmul.allow_tf32 = True
+
+
+def main():
+    # Fail fast on a typo rather than silently falling back to a half-configured path
+    if EMBEDDING_BACKEND not in EMBEDDING_BACKENDS:
+        raise ValueError(
+            f"Unsupported EMBEDDING_BACKEND '{EMBEDDING_BACKEND}'; expected one of {sorted(EMBEDDING_BACKENDS)}"
+        )
+
+    configure_torch()
+
+    # Using a local cache directory within the project to avoid potential permission issues
+    cache_dir = Path("./model_cache")
+    cache_dir.mkdir(exist_ok=True)
+
+    # Pick the device explicitly; FP16 only pays off on GPU (it is slower on CPU)
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+
+    # Re-runs reuse the sampled rows (keyed on the sample only) and, for the same
+    # model and device, their embeddings; delete the files in model_cache/ to
+    # force a re-sample or re-encode
+    if EMBEDDING_BACKEND == "onnx":
+        model_file = get_onnx_export(cache_dir, device)[1]
+    else:
+        model_file = "pytorch"
+    rows_cache = get_rows_cache_path(cache_dir)
+    embeddings_cache = get_embeddings_cache_path(cache_dir, device, model_file)
+    cached_rows = load_rows_cache(rows_cache)
+    cached_embeddings = None
+    if cached_rows is not None:
+        cached_embeddings = load_embeddings_cache(embeddings_cache, len(cached_rows[0]))
+    use_cache = cached_embeddings is not None
+
+    print("Step 1: Load the ModernBERT Model")
+    if use_cache:
+        print(f"Found cached embeddings at {embeddings_cache}, skipping model load.")
+        model = None
+    else:
+        # Load the SentenceTransformer model
+        print(f"Loading embedding model: {MODEL_NAME} on {device} ({EMBEDDING_BACKEND} backend)")
+        if EMBEDDING_BACKEND == "onnx":
+            model, onnx_file = load_onnx_model(cache_dir, device)
+            # The graph is only known once exported; key the new cache entry on it
+            embeddings_cache = get_embeddings_cache_path(cache_dir, device, onnx_file)
         else:
-            # Assign a zero vector or handle as appropriate if empty texts were possible
-            batch_embeddings.append([0.0] * model.get_sentence_embedding_dimension()) 
-            
-    batch["embeddings"] = batch_embeddings
-    return batch
-
-
-print("Generating embeddings (this might take a while)...")
-# Apply the function to the dataset using map with batching
-embeddings_ds = small_dataset.map(generate_embeddings_batch, batched=True, batch_size=32) # Adjust batch_size based on memory
-
-# --- Remove Pandas DataFrame conversion ---
-# print("Converting to Pandas DataFrame...")
-# df = embeddings_ds.to_pandas()
-
-# --- Determine max_text_length differently or use a safe default ---
-# Option 1: Iterate once (might still be memory intensive for huge datasets)
-# print("Calculating max text length by iteration...")
-# max_len_found = 0
-# for item in tqdm(embeddings_ds):
-#     max_len_found = max(max_len_found, len(item['text']))
-# max_text_length = min(max_len_found, 65530)
-
-# Option 2: Use a safe, large default value (simpler, less precise)
-print("Using safe default max text length for VARCHAR.")
-max_text_length = 65530 # Use a large but safe default for Milvus VARCHAR
-
-print(f"Max text length (capped/default): {max_text_length}")
-
-print("Step 4: Set Up the Milvus Vector Database")
-# Milvus connection details from environment variables
-DIMENSION = model.get_sentence_embedding_dimension() # Get dimension from model
-
-print(f"Connecting to Milvus at {MILVUS_URI}...")
-client = MilvusClient(uri=MILVUS_URI) # Use variable
-
-# Drop collection if it exists
-if client.has_collection(COLLECTION_NAME): # Use variable
-    print(f"Dropping existing collection: {COLLECTION_NAME}")
-    client.drop_collection(COLLECTION_NAME) # Use variable
-
-# Create schema
-print("Creating schema...")
-schema = MilvusClient.create_schema(
-    auto_id=True, # Let Milvus handle primary key generation
-    enable_dynamic_field=False, # Disable dynamic fields for clarity
-)
-
-# Add fields to schema
-# Milvus automatically creates and populates the 'id' field when auto_id=True and is_primary=True.
-schema.add_field(field_name="id", datatype=DataType.INT64, is_primary=True)
-schema.add_field(field_name="title", datatype=DataType.VARCHAR, max_length=1024) # Add title field
-schema.add_field(field_name="abstract", datatype=DataType.VARCHAR, max_length=max_text_length) # Add abstract field separately
-schema.add_field(field_name="text", datatype=DataType.VARCHAR, max_length=max_text_length) # Keep combined text for potential future use or different search strategies
-schema.add_field(field_name="dense_vector", datatype=DataType.FLOAT_VECTOR, dim=DIMENSION)
-
-# Prepare index parameters
-print("Preparing index parameters...")
-index_params = client.prepare_index_params()
-
-# Add index for the vector field
-index_params.add_index(
-    field_name="dense_vector",
-    index_type="AUTOINDEX", # Let Milvus choose the best index
-    metric_type="COSINE" # Use COSINE similarity
-)
-
-# Create collection
-print(f"Creating collection: {COLLECTION_NAME} with dimension {DIMENSION}") # Use variable
-client.create_collection(
-    collection_name=COLLECTION_NAME, # Use variable
-    schema=schema,
-    index_params=index_params
-)
-
-print(f"Collection {COLLECTION_NAME} created successfully.") # Use variable
-
-print("Step 5: Insert Data into Milvus")
-# --- Insert data directly from dataset in batches ---
-batch_size = 100 # Adjust based on memory/performance
-print(f"Inserting {len(embeddings_ds)} records in batches of {batch_size}...")
-
-for i in tqdm(range(0, len(embeddings_ds), batch_size)):
-    # Select a batch from the Hugging Face dataset
-    batch_indices = range(i, min(i + batch_size, len(embeddings_ds)))
-    batch_ds = embeddings_ds.select(batch_indices)
-
-    # Prepare batch data directly from the dataset batch
-    batch_data = [
-        {
-            "title": batch_ds[j]["title"],
-            "abstract": batch_ds[j]["abstract"], # Get abstract directly
-            "text": batch_ds[j]["text"], # Keep combined text
-            "dense_vector": batch_ds[j]["embeddings"]
-        }
-        for j in range(len(batch_ds))
-    ]
+            model = SentenceTransformer(MODEL_NAME, cache_folder=str(cache_dir), device=device)
+            if device == "cuda":
+                model = model.half()
+        print("Embedding model loaded.")
+
+    print("Step 2: Prepare the Dataset")
+    if cached_rows is not None:
+        print(f"Using cached rows from {rows_cache}.")
+        titles, abstracts = cached_rows
+    else:
+        # Stream the dataset rather than materializing the full split and
+        # rewriting it to shuffle; only the two needed columns are decoded
+        ds = load_dataset(DATASET_NAME, split="train", streaming=True)
+        ds = ds.select_columns(["title", "abstract"])
+
+        # Reservoir-sample SAMPLE_SIZE rows for demo. A buffered streaming
+        # shuffle would only draw from the first rows of the stream; this makes
+        # one pass over the split so every row is equally likely to be picked
+        print(f"Sampling {SAMPLE_SIZE} rows...")
+        rows = reservoir_sample(ds, SAMPLE_SIZE, SAMPLE_SEED)
+
+        # Keep only the "title" and "abstract" columns as plain Python lists
+        titles = [row["title"] for row in rows]
+        abstracts = [row["abstract"] for row in rows]
+        # Saved right away so a different model or device can reuse the sample
+        save_rows_cache(rows_cache, titles, abstracts)
+
+    document_prefix = "search_document:"
+
+    # Concatenate abstract and titles
+    print("Combining title and abstract...")
+    texts = [f"{document_prefix} {title} {abstract}" for title, abstract in zip(titles, abstracts)]
+
+    print(f"Number of rows to process: {len(texts)}")
+
+    # --- Remove Pandas DataFrame conversion ---
+    # print("Converting to Pandas DataFrame...")
+    # df = pd.DataFrame(rows)
+
+    # --- Size VARCHAR fields from the data instead of a worst-case default ---
+    # Milvus max_length counts UTF-8 bytes; the columns are already in memory so
+    # one pass is cheap. A little headroom is kept, capped at the VARCHAR limit
+    max_text_length = min(max(len(a.encode("utf-8")) for a in abstracts) + 64, 65530)
+    max_title_length = min(max(len(t.encode("utf-8")) for t in titles) + 64, 65530)
+
+    print(f"Max abstract length: {max_text_length}, max title length: {max_title_length}")
+
+    print("Step 3: Set Up the Milvus Vector Database")
+    # Milvus connection details from environment variables
+    DIMENSION = cached_embeddings.shape[1] if use_cache else model.get_sentence_embedding_dimension() # Get dimension from model
+
+    print(f"Connecting to Milvus at {MILVUS_URI}...")
+    client = get_client()
+
+    # Drop collection if it exists
+    if client.has_collection(COLLECTION_NAME): # Use variable
+        print(f"Dropping existing collection: {COLLECTION_NAME}")
+        client.drop_collection(COLLECTION_NAME) # Use variable
+
+    # Create schema
+    print("Creating schema...")
+    schema = MilvusClient.create_schema(
+        auto_id=True, # Let Milvus handle primary key generation
+        enable_dynamic_field=False, # Disable dynamic fields for clarity
+    )
+
+    # Add fields to schema
+    # Milvus automatically creates and populates the 'id' field when auto_id=True and is_primary=True.
+    schema.add_field(field_name="id", datatype=DataType.INT64, is_primary=True)
+    schema.add_field(field_name="title", datatype=DataType.VARCHAR, max_length=max_title_length) # Add title field
+    schema.add_field(field_name="abstract", datatype=DataType.VARCHAR, max_length=max_text_length) # Add abstract field separately
+    schema.add_field(field_name="dense_vector", datatype=DataType.FLOAT16_VECTOR, dim=DIMENSION) # Half-precision storage; queries must send float16 vectors too
+
+    # Prepare index parameters
+    print("Preparing index parameters...")
+    index_params = client.prepare_index_params()
+
+    # Add index for the vector field
+    index_params.add_index(
+        field_name="dense_vector",
+        index_type="HNSW", # Explicit graph index instead of AUTOINDEX
+        metric_type="COSINE", # Use COSINE similarity
+        params={"M": 16, "efConstruction": 200}
+    )
+
+    # Create collection
+    print(f"Creating collection: {COLLECTION_NAME} with dimension {DIMENSION}") # Use variable
+    client.create_collection(
+        collection_name=COLLECTION_NAME, # Use variable
+        schema=schema,
+        num_shards=MILVUS_NUM_SHARDS, # Spread inserts across DataNodes
+        consistency_level="Bounded" # Avoid strong-consistency waits during bulk insert
+    )
+    # Create the index separately: passing index_params to create_collection also
+    # runs a blocking load, which would keep the collection loaded during inserts
+    client.create_index(collection_name=COLLECTION_NAME, index_params=index_params) # Use variable
+
+    print(f"Collection {COLLECTION_NAME} created successfully.") # Use variable
+
+    print("Step 4: Generate Embeddings and Insert Data into Milvus")
+    # Encoding and insertion are pipelined: the main thread encodes chunks and
+    # queues them while insert threads send earlier chunks to Milvus, so neither
+    # the model nor the server sits idle waiting for the other
+    chunk_size = 512 # Rows encoded and inserted per pipeline step
+    insert_workers = 8 # Concurrent insert requests sent to Milvus
+    print(f"Embedding and inserting {len(texts)} records in chunks of {chunk_size} (this might take a while)...")
+
+    # Sort texts by length so each batch holds similarly sized inputs and wastes
+    # little compute on padding. Rows are inserted in this order; with auto_id
+    # primary keys the order in the collection does not matter
+    order = np.argsort([len(text) for text in texts], kind="stable")
+    sorted_texts = [texts[i] for i in order]
+    sorted_titles = [titles[i] for i in order]
+    sorted_abstracts = [abstracts[i] for i in order]
+
+    # MilvusClient.insert only takes row dicts, so inserts go through the ORM
+    # Collection, which accepts column-based data without a per-row transpose
+    connections.connect(alias="ingest", uri=MILVUS_URI)
+    collection = Collection(COLLECTION_NAME, using="ingest")
+
+    # Bounded so encoded chunks cannot pile up in memory if Milvus falls behind
+    insert_queue = queue.Queue(maxsize=4)
+    insert_errors = []
+
+    def insert_worker():
+        while True:
+            item = insert_queue.get()
+            if item is None:
+                break
+            start, end, vectors = item
+            # Columns in schema order (the auto_id primary key is omitted).
+            # Vectors stay a contiguous float16 array, never Python float lists
+            batch_data = [
+                sorted_titles[start:end],
+                sorted_abstracts[start:end],
+                vectors,
+            ]
+            try:
+                res = collection.insert(batch_data)
+                # Optional: Check insertion results if needed
+                # print(f"Inserted rows {start}-{end}, IDs: {res.insert_count}")
+            except Exception as e:
+                print(f"Error inserting rows {start}-{end}: {e}")
+                insert_errors.append(e)
+
+    workers = [threading.Thread(target=insert_worker) for _ in range(insert_workers)]
+    for worker in workers:
+        worker.start()
 
     try:
-        res = client.insert(collection_name=COLLECTION_NAME, data=batch_data) # Use variable
-        # Optional: Check insertion results if needed
-        # print(f"Inserted batch {i//batch_size + 1}, IDs: {res['insert_count']}")
+        # All embeddings live in one contiguous float16 array in dataset order
+        # (matching the FLOAT16_VECTOR field). Freshly encoded chunks are
+        # scattered into it as they arrive, so the cast and the reorder happen in
+        # a single pass. Insert payloads are row blocks of float16 data and are
+        # never turned into Python float lists
+        if use_cache:
+            embeddings = cached_embeddings
+            chunks = (
+                (start, min(start + chunk_size, len(sorted_texts)), embeddings[order[start:start + chunk_size]])
+                for start in range(0, len(sorted_texts), chunk_size)
+            )
+        else:
+            embeddings = np.empty((len(sorted_texts), DIMENSION), dtype=np.float16)
+            chunks = iter_embedding_chunks(model, sorted_texts, chunk_size)
+
+        for start, end, vectors in tqdm(chunks, total=-(-len(sorted_texts) // chunk_size)):
+            if not use_cache:
+                embeddings[order[start:end]] = vectors
+            insert_queue.put((start, end, vectors))
+    finally:
+        # One sentinel per worker; they drain the remaining chunks first
+        for _ in workers:
+            insert_queue.put(None)
+        for worker in workers:
+            worker.join()
+
+    if insert_errors:
+        print(f"{len(insert_errors)} chunks failed to insert.")
+    connections.disconnect("ingest")
+
+    if not use_cache:
+        print(f"Caching embeddings under {cache_dir} for future runs...")
+        save_embeddings_cache(embeddings_cache, embeddings)
+    print("Data insertion complete.")
+    print("Flushing collection to ensure data persistence...")
+    client.flush(collection_name=COLLECTION_NAME) # Use variable
+    print("Flush complete.")
+
+    # Optional: Verify count after flushing and loading (set VERIFY_COUNT=1)
+    if os.getenv("VERIFY_COUNT"):
+        try:
+            print(f"Loading collection {COLLECTION_NAME} for verification...") # Use variable
+            client.load_collection(collection_name=COLLECTION_NAME) # Use variable
+            print("Collection loaded.")
+            count = client.query(collection_name=COLLECTION_NAME, filter="", output_fields=["count(*)"]) # Use variable
+            print(f"Verification: Number of entities in collection: {count[0]['count(*)']}")
+        except Exception as e:
+            print(f"Could not verify entity count: {e}")
+    else:
+        # The collection was created without loading it, so request the load now
+        # without waiting for it to finish; Milvus keeps loading server-side
+        # after the script exits
+        try:
+            print(f"Requesting load of collection {COLLECTION_NAME} (not waiting for completion)...")
+            client.load_collection(collection_name=COLLECTION_NAME, _async=True) # Use variable
+        except Exception as e:
+            print(f"Could not request collection load: {e}")
+
+    # --- Save titles for suggestions ---
+    try:
+        print("Extracting titles for suggestions...")
+        # ArXiv titles can contain line breaks; collapse whitespace so each title
+        # stays on one line of the file that main.py reads line by line
+        all_titles = [" ".join(title.split()) for title in titles]
+        titles_file = "indexed_titles.txt"
+        with open(titles_file, "w", encoding="utf-8") as f:
+            f.write("\n".join(all_titles) + "\n")
+        print(f"Saved {len(all_titles)} titles to {titles_file}")
     except Exception as e:
-        print(f"Error inserting batch {i//batch_size + 1}: {e}")
-        # Decide how to handle errors: break, continue, log, etc.
-        break 
-
-print("Data insertion complete.")
-print("Flushing collection to ensure data persistence...")
-client.flush(collection_name=COLLECTION_NAME) # Use variable
-print("Flush complete.")
-
-# Optional: Verify count after flushing and loading
-try:
-    print(f"Loading collection {COLLECTION_NAME} for verification...") # Use variable
-    client.load_collection(collection_name=COLLECTION_NAME) # Use variable
-    print("Collection loaded.")
-    count = client.query(collection_name=COLLECTION_NAME, filter="", output_fields=["count(*)"]) # Use variable
-    print(f"Verification: Number of entities in collection: {count[0]['count(*)']}")
-except Exception as e:
-    print(f"Could not verify entity count: {e}")
-
-# --- Save titles for suggestions ---
-try:
-    print("Extracting titles for suggestions...")
-    # Extract titles directly from the dataset (before embedding generation if possible, or after)
-    # Using embeddings_ds here as it's readily available after the map operation
-    all_titles = embeddings_ds["title"]
-    titles_file = "indexed_titles.txt"
-    with open(titles_file, "w", encoding="utf-8") as f:
-        for title in all_titles:
-            f.write(f"{title}\n")
-    print(f"Saved {len(all_titles)} titles to {titles_file}")
-except Exception as e:
-    print(f"Error saving titles for suggestions: {e}")
-# --- End save titles ---
-
-print("Ingestion script finished.")
+        print(f"Error saving titles for suggestions: {e}")
+    # --- End save titles ---
+
+    print("Ingestion script finished.")
+
+
+# Worker processes of the encoding pool are spawned and re-import this module,
+# so the ingestion steps must only run from the entry point
+if __name__ == "__main__":
+    main()
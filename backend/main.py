@@ -3,13 +3,14 @@ from typing import List
 from fastapi import FastAPI, Query, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 import os
+import numpy as np
 from dotenv import load_dotenv
 from rapidfuzz.process import extract
 import uvicorn
 from sentence_transformers import SentenceTransformer
 from contextlib import asynccontextmanager
 from pymilvus import MilvusException # Import MilvusException
-from query_engline import client
+from query_engline import get_client
 
 load_dotenv() # Load variables from .env file
 
@@ -25,6 +26,7 @@ async def lifespan(app: FastAPI):
     print("Application startup: Loading Milvus collection...")
     try:
         # Ensure collection exists before loading (optional but good practice)
+        client = get_client()
         if not client.has_collection(COLLECTION_NAME):
              print(f"Collection {COLLECTION_NAME} not found. Please run ingest_data.py first.")
              # Decide behavior: raise error, exit, or continue without loading
@@ -45,6 +47,7 @@ async def lifespan(app: FastAPI):
     # Clean up resources (optional)
     print("Application shutdown: Releasing Milvus collection...")
     try:
+        client = get_client()
         if client.has_collection(COLLECTION_NAME): # Check again in case it was dropped
              client.release_collection(COLLECTION_NAME)
              print(f"Milvus collection '{COLLECTION_NAME}' released.")
@@ -111,16 +114,17 @@ def get_suggestions(query: str = Query(..., min_length=1), max_results: int = 5)
 
 def search_papers(query, max_results=10) -> List[dict]:
     query_prefix = "search_query:"
-    query_embeddings = model.encode(query_prefix + " " + query)
+    # The collection stores FLOAT16_VECTOR, so the query vector must be float16 too
+    query_embeddings = model.encode(query_prefix + " " + query, normalize_embeddings=True).astype(np.float16)
     # query_embeddings = model.encode(query) # Keep commented out line if desired
     try:
-        result = client.search(
+        result = get_client().search(
             collection_name=COLLECTION_NAME, # Use variable
             data=[query_embeddings],
             anns_field="dense_vector",
             limit=max_results,
             output_fields=["title", "abstract"], # Retrieve title and abstract
-            search_params={"metric_type": "COSINE"}
+            search_params={"metric_type": "COSINE", "params": {"ef": max(64, max_results)}} # HNSW ef must be >= limit
         )
         # print(result[0]) # Debugging print
         records = [
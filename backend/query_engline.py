@@ -1,9 +1,14 @@
+import functools
 import os
 from dotenv import load_dotenv
 from pymilvus import MilvusClient
 
 load_dotenv() # Load variables from .env file
 
-client = MilvusClient(
-    uri=os.getenv("MILVUS_URI", "http://localhost:19530") # Add default fallback
-)
+
+@functools.lru_cache(maxsize=1)
+def get_client() -> MilvusClient:
+    """Return the shared MilvusClient, connecting lazily on first use."""
+    return MilvusClient(
+        uri=os.getenv("MILVUS_URI", "http://localhost:19530") # Add default fallback
+    )